@@ -12,6 +12,7 @@ import rich
 import rich.markup
 import requests
 from cerche.custom_logging import print
+from cerche.rate_limit import RateLimitExceeded
 
 _STYLE_GOOD = "[green]"
 _STYLE_SKIP = ""
@@ -57,6 +58,14 @@ def _get_and_parse(url: str, timeout: int) -> Dict[str, str]:
 
 
 class SearchABCRequestHandler(http.server.BaseHTTPRequestHandler):
+    @classmethod
+    def detached(cls, server) -> "SearchABCRequestHandler":
+        """Build a handler not bound to any client connection, to run
+        `fetch_results` outside of an HTTP request (e.g. cache warm-up)."""
+        handler = cls.__new__(cls)
+        handler.server = server
+        return handler
+
     def do_GET(self):
         self.send_response(200)
         self.end_headers()
@@ -100,6 +109,83 @@ class SearchABCRequestHandler(http.server.BaseHTTPRequestHandler):
 
         n = int(parsed["n"])
         q = parsed["q"]
+        self.server.log_query(q, n)
+
+        try:
+            content = self.fetch_results(q=q, n=n)
+        except RateLimitExceeded as e:
+            # Fall back to an expired cache entry rather than failing
+            cache = self.server.cache
+            content = (
+                cache.get("results", self.result_cache_key(q, n), allow_expired=True)
+                if cache is not None
+                else None
+            )
+            if content is None:
+                print(f"[!] {e}, rejecting query")
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", 0)
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            print(f"[!] {e}, answering from expired cache")
+
+        ###############################################################
+        # Prepare the answer and send it
+        ###############################################################
+        output = json.dumps(dict(response=content)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", len(output))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(output)
+
+    def result_cache_key(self, q: str, n: int) -> str:
+        # Every option changing the content of the results is part of the key,
+        # so that servers with different options can share a cache file.
+        server = self.server
+        return json.dumps(
+            [
+                type(self).__name__,
+                server.use_official_google_api,
+                server.use_description_only,
+                server.strip_html_menus,
+                server.max_text_bytes,
+                (server.kwargs or {}).get("google_search_params"),
+                n,
+                q,
+            ]
+        )
+
+    def _get_page(self, url: str) -> Optional[Dict[str, str]]:
+        """Get a parsed page, from the shared cache when possible."""
+        cache = self.server.cache
+        if cache is not None:
+            cached = cache.get("pages", url)
+            if cached is not None:
+                return cached
+
+        page = _get_and_parse(url, self.server.requests_get_timeout)
+        if cache is not None and page is not None:
+            cache.set("pages", url, page)
+        return page
+
+    def fetch_results(self, q: str, n: int) -> List[Dict[str, str]]:
+        """Search, get the pages and parse their content.
+        Results are read from and written to the shared cache when enabled.
+        """
+        cache = self.server.cache
+        cache_key = self.result_cache_key(q, n)
+        if cache is not None:
+            cached = cache.get("results", cache_key)
+            if cached is not None:
+                print(
+                    f" {_STYLE_GOOD}>{_CLOSE_STYLE_GOOD} Cache hit for "
+                    f"`{rich.markup.escape(q)}`"
+                )
+                return cached
 
         # Over query a little bit in case we find useless URLs
         content = []
@@ -122,7 +208,7 @@ class SearchABCRequestHandler(http.server.BaseHTTPRequestHandler):
                 break
 
             # Get the content of the pages and parse it
-            maybe_content = _get_and_parse(url, self.server.requests_get_timeout)
+            maybe_content = self._get_page(url)
 
             # Check that getting the content didn't fail
             reason_empty_response = maybe_content is None
@@ -198,17 +284,12 @@ class SearchABCRequestHandler(http.server.BaseHTTPRequestHandler):
                     f"   {url}"
                 )
 
-        ###############################################################
-        # Prepare the answer and send it
-        ###############################################################
         content = content[:n]
-        output = json.dumps(dict(response=content)).encode("utf-8")
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.send_header("Content-Length", len(output))
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(output)
+        # An empty answer is likely a transient failure (timeouts, no results
+        # from a failing API), don't serve it again for a whole TTL.
+        if cache is not None and content:
+            cache.set("results", cache_key, content)
+        return content
 
     def search(
         self,
@@ -44,6 +44,7 @@ class BingSearchRequestHandler(SearchABCRequestHandler):
             "promote": promote,
             "answerCount": 5,
         }
+        self.server.rate_limiter.acquire()
         response = requests.get(
             BingSearchRequestHandler.bing_search_url, headers=headers, params=params
         )
@@ -0,0 +1,135 @@
+"""
+A small cache shared by every worker process of the server.
+It is backed by a local SQLite file so that a hit in one worker
+benefits all of them.
+"""
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+from typing import *
+from cerche.custom_logging import print
+
+_TABLES = ("results", "pages")
+_BUSY_TIMEOUT = 30.0  # seconds
+_PURGE_INTERVAL = 10 * 60  # seconds between purges of expired entries
+_POOL_SIZE = 8  # idle connections kept open
+
+
+class SharedCache:
+    """Cross-process key/value cache for search results and parsed pages.
+    Values are stored as JSON. SQLite connections are reused through a small
+    pool, opened lazily so that the cache can be created before forking
+    workers (a connection must not cross a fork).
+    Entries older than `ttl` are expired, they are deleted once older than
+    `ttl + grace` (kept meanwhile for `get(..., allow_expired=True)`).
+    """
+
+    def __init__(
+        self, path: str, ttl: Optional[int] = None, grace: Optional[int] = None
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.grace = ttl if grace is None else grace
+        self._pool: List[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        self._last_purge: Optional[float] = None
+        self._purge_lock = threading.Lock()
+
+        # Create the schema once, then close the connection: it must not be
+        # shared with the worker processes.
+        connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for table in _TABLES:
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+                )
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)"
+                )
+            connection.commit()
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _pooled_connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection from the pool, or open one if it's empty."""
+        with self._pool_lock:
+            connection = self._pool.pop() if self._pool else None
+        if connection is None:
+            # Request threads are short lived, connections are not tied to one
+            connection = sqlite3.connect(
+                self.path, timeout=_BUSY_TIMEOUT, check_same_thread=False
+            )
+            connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield connection
+        finally:
+            with self._pool_lock:
+                if len(self._pool) < _POOL_SIZE:
+                    self._pool.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+
+    def get(self, table: str, key: str, allow_expired: bool = False) -> Any:
+        """Return the cached value or None.
+        Expired entries are only returned with `allow_expired`.
+        """
+        assert table in _TABLES, table
+        try:
+            with self._pooled_connection() as connection:
+                row = connection.execute(
+                    f"SELECT value, created FROM {table} WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"[!] cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        value, created = row
+        if not allow_expired and self.ttl and time.time() - created > self.ttl:
+            return None
+        return json.loads(value)
+
+    def set(self, table: str, key: str, value: Any) -> None:
+        assert table in _TABLES, table
+        try:
+            with self._pooled_connection() as connection, connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {table} (key, value, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time()),
+                )
+        except sqlite3.Error as e:
+            print(f"[!] cache write failed: {e}")
+        self._maybe_purge()
+
+    def _maybe_purge(self) -> None:
+        """Delete the entries past their grace period, at most once per
+        _PURGE_INTERVAL in each process."""
+        if not self.ttl:
+            return
+        with self._purge_lock:
+            if (
+                self._last_purge is not None
+                and time.monotonic() - self._last_purge < _PURGE_INTERVAL
+            ):
+                return
+            self._last_purge = time.monotonic()
+        self.purge()
+
+    def purge(self) -> None:
+        if not self.ttl:
+            return
+        oldest = time.time() - self.ttl - self.grace
+        try:
+            with self._pooled_connection() as connection, connection:
+                for table in _TABLES:
+                    connection.execute(
+                        f"DELETE FROM {table} WHERE created < ?", (oldest,)
+                    )
+        except sqlite3.Error as e:
+            print(f"[!] cache purge failed: {e}")
@@ -1,10 +1,58 @@
+import threading
 from typing import *
 import googlesearch
 import requests
 from cerche.base import SearchABCRequestHandler
 from cerche.custom_logging import print
+from cerche.rate_limit import TokenBucket
+
+# googlesearch makes a variable number of HTTP requests per result page
+# (cookies from the home page, result pages with fewer results than asked
+# after filtering), so a token is taken for each of its HTTP requests.
+_scraping = threading.local()
+_install_lock = threading.Lock()
+_get_page = None
+
+
+def _rate_limited_get_page(*args, **kwargs):
+    rate_limiter = getattr(_scraping, "rate_limiter", None)
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    return _get_page(*args, **kwargs)
+
+
+def _install_rate_limited_get_page() -> None:
+    """Wrap googlesearch.get_page, on first use only: googlesearch-python
+    also provides a `googlesearch` module, without get_page."""
+    global _get_page
+    with _install_lock:
+        if _get_page is not None:
+            return
+        if not hasattr(googlesearch, "get_page"):
+            raise RuntimeError(
+                "Scraping Google requires the googlesearch module of the "
+                "`google` package, not the one of `googlesearch-python`"
+            )
+        _get_page = googlesearch.get_page
+        googlesearch.get_page = _rate_limited_get_page
+
+
+def _rate_limited(
+    results: Iterator[str], rate_limiter: TokenBucket
+) -> Generator[str, None, None]:
+    """Rate limit the HTTP requests googlesearch makes to get `results`.
+    They are made while the generator runs, in the thread consuming it.
+    """
+    while True:
+        _scraping.rate_limiter = rate_limiter
+        try:
+            url = next(results)
+        except StopIteration:
+            return
+        finally:
+            _scraping.rate_limiter = None
+        yield url
 
-_DELAY_SEARCH = 1.0  # Making this too low will get you IP banned
 
 class GoogleSearchRequestHandler(SearchABCRequestHandler):
     google_search_url = "https://customsearch.googleapis.com/customsearch/v1"
@@ -15,7 +63,12 @@ class GoogleSearchRequestHandler(SearchABCRequestHandler):
         n: int,
     ) -> Generator[str, None, None]:
         if not self.server.use_official_google_api:
-            return googlesearch.search(q, num=n, stop=None, pause=_DELAY_SEARCH)
+            # The shared rate limiter replaces googlesearch's own pause
+            _install_rate_limited_get_page()
+            return _rate_limited(
+                googlesearch.search(q, num=n, stop=None, pause=0),
+                self.server.rate_limiter,
+            )
         else:
             """
             https://developers.google.com/custom-search/json-api/v1/reference/cse/list
@@ -33,6 +86,7 @@ class GoogleSearchRequestHandler(SearchABCRequestHandler):
             if self.server.kwargs and "google_search_params" in self.server.kwargs:
                 url += "&" + self.server.kwargs["google_search_params"]
             # make the API request
+            self.server.rate_limiter.acquire()
             response = requests.get(url)
             response.raise_for_status()
             json_response = response.json()
@@ -45,6 +99,7 @@ class GoogleSearchRequestHandler(SearchABCRequestHandler):
             if "items" not in json_response or len(json_response["items"]) == 0:
                 # add in url intitle="information""
                 url = f"{base_url}&q=intitle:{q}&num={n}"
+                self.server.rate_limiter.acquire()
                 response = requests.get(url)
                 response.raise_for_status()
                 json_response = response.json()
@@ -1,18 +1,43 @@
 """
 A search engine API for ParlAI search augmented conversational AI.
 """
+import functools
 import http.server
+import json
 import re
+import signal
+import socket
+import threading
 from typing import *
 import fire
 import parlai.agents.rag.retrieve_api
 from cerche.bing import BingSearchRequestHandler
+from cerche.cache import SharedCache
 from cerche.google import GoogleSearchRequestHandler
+from cerche.rate_limit import TokenBucket
+from cerche.supervisor import Supervisor
+from cerche.warm_up import read_top_queries, warm_up_cache
 from cerche.custom_logging import print
 
 _DEFAULT_HOST = "0.0.0.0"
 _DEFAULT_PORT = 8080
 _REQUESTS_GET_TIMEOUT = 5  # seconds
+_CACHE_TTL = 24 * 60 * 60  # seconds
+_DRAIN_TIMEOUT = 25  # seconds, must stay below the supervisor's kill delay
+# Default (calls per second, burst) allowed to each search backend
+_SEARCH_RATE_LIMITS = {
+    # Making this too high will get you IP banned. A query makes at least
+    # 2 calls (cookies from the home page, then the results page).
+    "google": (1.0, 2),
+    "google_api": (10.0, 10),
+    "bing": (3.0, 3),
+}
+_SEARCH_QUEUE_SIZE = 32
+_SEARCH_MAX_WAIT = 10.0  # seconds
+_WARM_UP_TOP_K = 100
+_WARM_UP_N = 5
+_WARM_UP_PARALLELISM = 4
+_WARM_UP_INTERVAL = 1.0  # seconds between background warm-up queries
 
 
 def _parse_host(host: str) -> Tuple[str, int]:
@@ -40,6 +65,11 @@ class SearchABCServer(http.server.ThreadingHTTPServer):
         google_search_key: str = None,
         google_search_cx: str = None,
         use_dataset_urls: str = None,
+        cache: SharedCache = None,
+        reuse_port: bool = False,
+        rate_limiter: TokenBucket = None,
+        query_log: str = None,
+        bind_and_activate: bool = True,
         **kwargs,
     ):
 
@@ -52,8 +82,187 @@ class SearchABCServer(http.server.ThreadingHTTPServer):
         self.google_search_key = google_search_key
         self.google_search_cx = google_search_cx
         self.kwargs = kwargs["kwargs"]
+        self.cache = cache
+        self.reuse_port = reuse_port
+        self.rate_limiter = rate_limiter
+        self.query_log = query_log
+        self._query_log_lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_changed = threading.Condition()
 
-        super().__init__(server_address, RequestHandlerClass)
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    def log_query(self, q: str, n: int) -> None:
+        """Append a received query to the query log, if any."""
+        if not self.query_log:
+            return
+        line = json.dumps(dict(q=q, n=n)) + "\n"
+        # Append mode keeps the lines of concurrent workers whole
+        with self._query_log_lock, open(self.query_log, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def server_bind(self):
+        # Lets several worker processes listen on the same port,
+        # the kernel balances the connections between them.
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self._in_flight_changed:
+            self._in_flight += 1
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._in_flight_changed:
+                self._in_flight -= 1
+                self._in_flight_changed.notify_all()
+
+    def wait_in_flight(self, timeout: float) -> bool:
+        """Wait for the requests being handled to finish.
+        Returns False if some are still running after `timeout` seconds.
+        """
+        with self._in_flight_changed:
+            return self._in_flight_changed.wait_for(
+                lambda: self._in_flight == 0, timeout
+            )
+
+
+def _add_dataset_urls(use_dataset_urls: str, kwargs: Dict[str, Any]) -> None:
+    """Restrict the Google searches to the websites of a Huggingface dataset,
+    through kwargs["google_search_params"]."""
+    import gcsfs
+    from datasets import load_from_disk
+
+    gcs = gcsfs.GCSFileSystem()
+
+    dataset = load_from_disk(use_dataset_urls, fs=gcs)
+    df = dataset.to_pandas()
+    unique_websites = list(
+        set(
+            [
+                re.sub(r"^https?://(www\.)?", "", url).split("/")[0]
+                for url in df["url"]
+            ]
+        )
+    )
+    if len(unique_websites) > 200:
+        print("[!] clipping to 200 websites")
+        unique_websites = unique_websites[:200]
+    print("using", len(unique_websites), "dataset urls")
+    websites_as_google_search_params = "&".join(
+        [f"siteSearch={website}" for website in unique_websites]
+    )
+    # add in kwargs google search params
+    kwargs["google_search_params"] = (
+        kwargs["google_search_params"] + websites_as_google_search_params
+        if "google_search_params" in kwargs
+        else websites_as_google_search_params
+    )
+
+
+def _make_handler_and_rate_limit(
+    search_engine: str,
+    use_official_google_api: bool,
+    search_rate: Optional[float],
+    search_burst: Optional[int],
+    search_queue_size: int,
+    search_max_wait: float,
+) -> Tuple[type, Dict[str, Any]]:
+    """Pick the request handler and the TokenBucket arguments of the backend."""
+    if search_engine == "Bing":
+        request_handler = BingSearchRequestHandler
+        backend = "bing"
+    else:
+        request_handler = GoogleSearchRequestHandler
+        backend = "google_api" if use_official_google_api else "google"
+
+    default_rate, default_burst = _SEARCH_RATE_LIMITS[backend]
+    burst = search_burst or default_burst
+    rate_limit = dict(
+        rate=search_rate or default_rate,
+        burst=burst,
+        max_waiting=search_queue_size,
+        max_wait=search_max_wait,
+        # Shared by the buckets of all the workers
+        state=TokenBucket.shared_state(burst),
+    )
+    return request_handler, rate_limit
+
+
+def _background_warm_up(server, query_log: str, top_k: int) -> None:
+    """Warm the cache up at low priority, never failing the server."""
+    try:
+        queries = read_top_queries(query_log, top_k, _WARM_UP_N)
+    except OSError as e:
+        print(f"[!] can't read the warm-up query log: {e}")
+        return
+    warm_up_cache(server, queries, interval=_WARM_UP_INTERVAL)
+
+
+def _run_server(
+    worker_id: Optional[int],
+    server_options: Dict[str, Any],
+    cache_options: Optional[Dict[str, Any]],
+    rate_limit: Dict[str, Any],
+    warm_up_query_log: Optional[str] = None,
+    warm_up_top_k: int = _WARM_UP_TOP_K,
+) -> None:
+    """Serve until interrupted, or until drained by SIGTERM.
+    worker_id is None when running without a supervisor.
+    The cache and the rate limiter are built here, from plain options,
+    as they can't be sent to a worker process.
+    The most frequent queries of warm_up_query_log are fetched into the cache
+    in the background by a single worker, at low priority.
+    """
+    server_options = dict(
+        server_options,
+        cache=SharedCache(**cache_options) if cache_options else None,
+        rate_limiter=TokenBucket(**rate_limit),
+    )
+    with SearchABCServer(**server_options) as server:
+
+        def drain(signum, frame):
+            # shutdown() blocks until serve_forever() returns,
+            # it must not be called from the serving thread.
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, drain)
+        if worker_id is not None:
+            # Ctrl+C is handled by the supervisor, which drains the workers.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        hostname, port = server_options["server_address"]
+        if worker_id is None:
+            print("Serving forever.")
+        else:
+            print(f"Worker {worker_id} serving.")
+        print(f"Host: {hostname}:{port}")
+
+        if warm_up_query_log and worker_id in (None, 0):
+            threading.Thread(
+                target=_background_warm_up,
+                args=(server, warm_up_query_log, warm_up_top_k),
+                name="warm-up",
+                daemon=True,
+            ).start()
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print("Shutting down.")
+            # Stop accepting connections right away: with SO_REUSEPORT, the
+            # kernel would keep queuing new ones to this draining worker.
+            server.socket.close()
+            if not server.wait_in_flight(_DRAIN_TIMEOUT):
+                print("[!] some requests were still running")
+            # Clean-up server (close socket, etc.)
+            server.server_close()
 
 
 class Application:
@@ -70,6 +279,16 @@ class Application:
         google_search_key: str = None,
         google_search_cx: str = None,
         use_dataset_urls: str = None,
+        workers: int = 1,
+        cache_path: str = None,
+        cache_ttl: int = _CACHE_TTL,
+        search_rate: float = None,
+        search_burst: int = None,
+        search_queue_size: int = _SEARCH_QUEUE_SIZE,
+        search_max_wait: float = _SEARCH_MAX_WAIT,
+        query_log: str = None,
+        warm_up_query_log: str = None,
+        warm_up_top_k: int = _WARM_UP_TOP_K,
         **kwargs,
     ) -> NoReturn:
         """Main entry point: Start the server.
@@ -85,6 +304,16 @@ class Application:
             google_search_key (str):
             google_search_cx (str):
             use_dataset_urls (str):
+            workers (int):
+            cache_path (str):
+            cache_ttl (int):
+            search_rate (float):
+            search_burst (int):
+            search_queue_size (int):
+            search_max_wait (float):
+            query_log (str):
+            warm_up_query_log (str):
+            warm_up_top_k (int):
         HOSTNAME:PORT of the server. HOSTNAME can be an IP.
         Most of the time should be 0.0.0.0. Port 8080 doesn't work on colab.
         Other ports also probably don't work on colab, test it out.
@@ -103,39 +332,29 @@ class Application:
             https://developers.google.com/custom-search/v1/overview
         google_search_cx is the search engine ID.
         use_dataset_urls will use a list of url from a Huggingface dataset hosted on GCP.
+        workers is the number of server processes. With more than one, they all
+            listen on the same port (SO_REUSEPORT) and a supervisor restarts
+            the ones that crash.
+        cache_path is a SQLite file caching search results and parsed pages,
+            shared by all workers. No caching if not set.
+        cache_ttl is how long, in seconds, a cache entry stays fresh.
+        search_rate and search_burst limit the calls per second to the search
+            engine, shared by all request threads. Defaults depend on the engine,
+            1 call per second with bursts of 2 when scraping Google, where
+            a query costs at least 2 calls. Shared by all the workers.
+        search_queue_size is how many queries can wait for the rate limiter,
+            at most search_max_wait seconds. Past that, queries are answered
+            from an expired cache entry if any, or rejected with a 429.
+        query_log is a file where each received query is appended as a JSON line.
+        warm_up_query_log is a query log (e.g. the query_log of a previous run)
+            whose warm_up_top_k most frequent queries are fetched into the
+            cache in the background, at low priority. Requires cache_path.
         """
         hostname, port = _parse_host(host)
         host = f"{hostname}:{port}"
 
         if use_dataset_urls:
-            import gcsfs
-            from datasets import load_from_disk
-
-            gcs = gcsfs.GCSFileSystem()
-
-            dataset = load_from_disk(use_dataset_urls, fs=gcs)
-            df = dataset.to_pandas()
-            unique_websites = list(
-                set(
-                    [
-                        re.sub(r"^https?://(www\.)?", "", url).split("/")[0]
-                        for url in df["url"]
-                    ]
-                )
-            )
-            if len(unique_websites) > 200:
-                print("[!] clipping to 200 websites")
-                unique_websites = unique_websites[:200]
-            print("using", len(unique_websites), "dataset urls")
-            websites_as_google_search_params = "&".join(
-                [f"siteSearch={website}" for website in unique_websites]
-            )
-            # add in kwargs google search params
-            kwargs["google_search_params"] = (
-                kwargs["google_search_params"] + websites_as_google_search_params
-                if "google_search_params" in kwargs
-                else websites_as_google_search_params
-            )
+            _add_dataset_urls(use_dataset_urls, kwargs)
 
         self.check_and_print_cmdline_args(
             requests_get_timeout,
@@ -148,15 +367,34 @@ class Application:
             google_search_key,
             google_search_cx,
             use_dataset_urls,
+            workers,
+            cache_path,
+            cache_ttl,
+            search_rate,
+            search_burst,
+            search_queue_size,
+            search_max_wait,
             kwargs,
         )
+        if warm_up_query_log and not cache_path:
+            print("Warning: warm_up_query_log requires cache_path")
+            exit()
 
-        if search_engine == "Bing":
-            request_handler = BingSearchRequestHandler
-        else:
-            request_handler = GoogleSearchRequestHandler
+        request_handler, rate_limit = _make_handler_and_rate_limit(
+            search_engine,
+            use_official_google_api,
+            search_rate,
+            search_burst,
+            search_queue_size,
+            search_max_wait,
+        )
+        cache_options = None
+        if cache_path:
+            cache_options = dict(path=cache_path, ttl=cache_ttl)
+            # Creates the schema before starting the workers
+            SharedCache(**cache_options)
 
-        with SearchABCServer(
+        server_options = dict(
             server_address=(hostname, int(port)),
             RequestHandlerClass=request_handler,
             requests_get_timeout=requests_get_timeout,
@@ -168,18 +406,141 @@ class Application:
             google_search_key=google_search_key,
             google_search_cx=google_search_cx,
             use_dataset_urls=use_dataset_urls,
+            reuse_port=workers > 1,
+            query_log=query_log,
             kwargs=kwargs,
-        ) as server:
-            print("Serving forever.")
+        )
+
+        if workers > 1:
+            print(f"Serving forever with {workers} workers.")
             print(f"Host: {host}")
-            try:
-                server.serve_forever()
-            except KeyboardInterrupt:
-                pass
-            finally:
-                print("Shutting down.")
-                # Clean-up server (close socket, etc.)
-                server.server_close()
+            succeeded = Supervisor(
+                target=functools.partial(
+                    _run_server,
+                    server_options=server_options,
+                    cache_options=cache_options,
+                    rate_limit=rate_limit,
+                    warm_up_query_log=warm_up_query_log,
+                    warm_up_top_k=warm_up_top_k,
+                ),
+                workers=workers,
+            ).run()
+            print("Shutting down.")
+            if not succeeded:
+                # Let Docker, systemd, etc. notice the failure
+                exit(1)
+        else:
+            _run_server(
+                None,
+                server_options,
+                cache_options,
+                rate_limit,
+                warm_up_query_log,
+                warm_up_top_k,
+            )
+
+    def warm_up(
+        self,
+        query_log: str,
+        cache_path: str,
+        top_k: int = _WARM_UP_TOP_K,
+        n: int = _WARM_UP_N,
+        parallelism: int = _WARM_UP_PARALLELISM,
+        cache_ttl: int = _CACHE_TTL,
+        requests_get_timeout: int = _REQUESTS_GET_TIMEOUT,
+        strip_html_menus: bool = False,
+        max_text_bytes: int = None,
+        search_engine: str = "Google",
+        use_description_only: bool = False,
+        subscription_key: str = None,
+        use_official_google_api: bool = False,
+        google_search_key: str = None,
+        google_search_cx: str = None,
+        use_dataset_urls: str = None,
+        search_rate: float = None,
+        search_burst: int = None,
+        search_max_wait: float = _SEARCH_MAX_WAIT,
+        **kwargs,
+    ) -> None:
+        """Precompute the results of the most frequent queries into the cache.
+        Run it before `serve` with the same options and cache_path, so that
+        the first queries after a deploy or restart are cache hits.
+        Don't run it alongside a live server: it has its own search rate
+        limit, which would double the calls to the search engine. Use the
+        warm_up_query_log option of `serve` instead.
+        Arguments:
+            query_log (str):
+            cache_path (str):
+            top_k (int):
+            n (int):
+            parallelism (int):
+        query_log is the query_log of a previous `serve` run, or a text file
+            with one query per line (fetched with `n` results).
+        top_k is the number of most frequent queries to fetch.
+        parallelism is the number of queries fetched at the same time,
+            still subject to the search rate limit.
+        The other arguments are the same as for `serve`, including kwargs
+        like google_search_params: results are cached per options.
+        """
+        if use_dataset_urls:
+            _add_dataset_urls(use_dataset_urls, kwargs)
+
+        search_queue_size = max(parallelism, _SEARCH_QUEUE_SIZE)
+        self.check_and_print_cmdline_args(
+            requests_get_timeout,
+            strip_html_menus,
+            max_text_bytes,
+            search_engine,
+            use_description_only,
+            subscription_key,
+            use_official_google_api,
+            google_search_key,
+            google_search_cx,
+            use_dataset_urls,
+            1,
+            cache_path,
+            cache_ttl,
+            search_rate,
+            search_burst,
+            search_queue_size,
+            search_max_wait,
+            kwargs,
+        )
+        if parallelism < 1:
+            print("Warning: parallelism must be at least 1")
+            exit()
+
+        request_handler, rate_limit = _make_handler_and_rate_limit(
+            search_engine,
+            use_official_google_api,
+            search_rate,
+            search_burst,
+            search_queue_size,
+            search_max_wait,
+        )
+        # Never bound: the pipeline runs outside of any HTTP request
+        server = SearchABCServer(
+            server_address=(_DEFAULT_HOST, _DEFAULT_PORT),
+            RequestHandlerClass=request_handler,
+            requests_get_timeout=requests_get_timeout,
+            strip_html_menus=strip_html_menus,
+            max_text_bytes=max_text_bytes,
+            use_description_only=use_description_only,
+            subscription_key=subscription_key,
+            use_official_google_api=use_official_google_api,
+            google_search_key=google_search_key,
+            google_search_cx=google_search_cx,
+            use_dataset_urls=use_dataset_urls,
+            cache=SharedCache(cache_path, cache_ttl),
+            rate_limiter=TokenBucket(**rate_limit),
+            bind_and_activate=False,
+            kwargs=kwargs,
+        )
+        try:
+            queries = read_top_queries(query_log, top_k, n)
+            warm_up_cache(server, queries, parallelism=parallelism)
+        finally:
+            server.server_close()
 
     def check_and_print_cmdline_args(
         self,
@@ -193,6 +554,13 @@ class Application:
         google_search_key,
         google_search_cx,
         use_dataset_urls,
+        workers,
+        cache_path,
+        cache_ttl,
+        search_rate,
+        search_burst,
+        search_queue_size,
+        search_max_wait,
         kwargs,
     ) -> None:
 
@@ -231,6 +599,20 @@ class Application:
                     print("https://developers.google.com/custom-search/v1/overview")
                     exit()
 
+        if workers < 1:
+            print("Warning: workers must be at least 1")
+            exit()
+        if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            print("Warning: workers > 1 requires SO_REUSEPORT, not supported here")
+            exit()
+
+        if search_rate is not None and search_rate <= 0:
+            print("Warning: search_rate must be positive")
+            exit()
+        if search_burst is not None and search_burst < 1:
+            print("Warning: search_burst must be at least 1")
+            exit()
+
         print("Command line args used:")
         print(f"  requests_get_timeout={requests_get_timeout}")
         print(f"  strip_html_menus={strip_html_menus}")
@@ -242,6 +624,13 @@ class Application:
         print(f"  google_search_key={google_search_key}")
         print(f"  google_search_cx={google_search_cx}")
         print(f"  use_dataset_urls={use_dataset_urls}")
+        print(f"  workers={workers}")
+        print(f"  cache_path={cache_path}")
+        print(f"  cache_ttl={cache_ttl}")
+        print(f"  search_rate={search_rate}")
+        print(f"  search_burst={search_burst}")
+        print(f"  search_queue_size={search_queue_size}")
+        print(f"  search_max_wait={search_max_wait}")
         # overflow elipsis if the kwargs are too big
         clipped_kwargs = [
             f"{k}={v}" if len(f"{k}={v}") < 100 else f"{k}=<{len(v)} bytes>"
@@ -0,0 +1,139 @@
+"""
+Rate limiting of the calls made to the upstream search engines.
+One token bucket is shared by all the request threads of a server,
+and by all its worker processes.
+"""
+import collections
+import contextlib
+import multiprocessing
+import threading
+import time
+from typing import *
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call can't get a token: the wait queue is full
+    or the call waited too long."""
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` calls per second with bursts of `burst` calls.
+    Callers that can't get a token right away wait in a bounded FIFO queue,
+    so they are served in arrival order.
+    The tokens live in `state`, from `TokenBucket.shared_state`: buckets of
+    several processes built with the same state share the same budget.
+    Waiting queues are per process.
+    Calls made in a `low_priority()` context don't join the queue: they wait
+    for the bucket to be full, i.e. for the backend to be idle.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        max_waiting: int,
+        max_wait: float,
+        state=None,
+    ):
+        assert rate > 0, rate
+        assert burst >= 1, burst
+        self.rate = rate
+        self.burst = burst
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._state = state if state is not None else self.shared_state(burst)
+        self._waiting: Deque[object] = collections.deque()
+        self._changed = threading.Condition()
+        self._low_priority = threading.local()
+
+    @staticmethod
+    def shared_state(burst: int):
+        """Tokens and last refill time, in memory shared with child processes."""
+        return multiprocessing.Array("d", [float(burst), time.monotonic()])
+
+    @contextlib.contextmanager
+    def low_priority(self) -> Iterator[None]:
+        """Make the calls of the current thread low priority."""
+        self._low_priority.enabled = True
+        try:
+            yield
+        finally:
+            self._low_priority.enabled = False
+
+    def _try_take(self, needed: float = 1) -> float:
+        """Take a token if `needed` ones are available and return 0.
+        Otherwise return the seconds until they are.
+        """
+        with self._state.get_lock():
+            tokens, updated = self._state[0], self._state[1]
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= needed else (needed - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            self._state[0], self._state[1] = tokens, now
+            return wait
+
+    def acquire(self) -> None:
+        """Take a token, waiting for one if needed.
+        Raises RateLimitExceeded if the queue is full or on timeout.
+        """
+        if getattr(self._low_priority, "enabled", False):
+            return self._acquire_when_idle()
+
+        with self._changed:
+            if not self._waiting and not self._try_take():
+                return
+
+            if len(self._waiting) >= self.max_waiting:
+                raise RateLimitExceeded(
+                    f"{len(self._waiting)} calls already waiting for a token"
+                )
+
+            ticket = object()
+            self._waiting.append(ticket)
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while True:
+                    first = self._waiting[0] is ticket
+                    if first:
+                        next_token = self._try_take()
+                        if not next_token:
+                            return
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RateLimitExceeded(
+                            f"no token available after {self.max_wait} seconds"
+                        )
+                    if first:
+                        # Sleep until the next token is due, another process
+                        # may take it first, then we wait again.
+                        remaining = min(remaining, next_token)
+                    self._changed.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self._changed.notify_all()
+
+    def _acquire_when_idle(self) -> None:
+        """Take a token once no call of this process is waiting and the bucket
+        is full, so that other calls always go first.
+        Raises RateLimitExceeded on timeout.
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._changed:
+            while True:
+                next_token = None
+                if not self._waiting:
+                    next_token = self._try_take(self.burst)
+                    if not next_token:
+                        return
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RateLimitExceeded(
+                        f"search backend still busy after {self.max_wait} seconds"
+                    )
+                if next_token is not None:
+                    remaining = min(remaining, next_token)
+                self._changed.wait(remaining)
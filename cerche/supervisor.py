@@ -0,0 +1,121 @@
+"""
+Pre-fork supervisor: runs N worker processes serving on the same port
+(each one binds its own socket with SO_REUSEPORT), restarts the ones that
+crash and drains them gracefully on shutdown.
+"""
+import multiprocessing
+import signal
+import time
+from typing import *
+from cerche.custom_logging import print
+
+_POLL_INTERVAL = 0.5  # seconds
+_RESTART_DELAY = 1.0  # seconds, doubled after each quick failure
+_MAX_RESTART_DELAY = 60.0  # seconds
+_QUICK_FAILURE = 10.0  # seconds, a worker dying faster failed at startup
+_MAX_QUICK_FAILURES = 5  # in a row, then the supervisor gives up
+_DRAIN_TIMEOUT = 30.0  # seconds before stragglers get killed
+
+
+class Supervisor:
+    """Start `workers` processes running `target(worker_id)` and keep them alive.
+    `target` must install its own SIGTERM handler to stop serving gracefully.
+    Workers failing at startup are restarted with an exponential backoff,
+    until _MAX_QUICK_FAILURES in a row stop the supervisor.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[int], None],
+        workers: int,
+        drain_timeout: float = _DRAIN_TIMEOUT,
+    ):
+        self.target = target
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._started: Dict[int, float] = {}
+        self._quick_failures: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+        self._failed = False
+
+    def _spawn(self, worker_id: int) -> None:
+        process = multiprocessing.Process(
+            target=self.target,
+            args=(worker_id,),
+            name=f"cerche-worker-{worker_id}",
+        )
+        process.start()
+        self._processes[worker_id] = process
+        self._started[worker_id] = time.monotonic()
+        print(f"Started worker {worker_id} (pid {process.pid})")
+
+    def _request_stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def run(self) -> bool:
+        """Supervise the workers until stopped.
+        Returns False if it gave up on workers failing at startup.
+        """
+        signal.signal(signal.SIGTERM, self._request_stop)
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        try:
+            while not self._stopping:
+                time.sleep(_POLL_INTERVAL)
+                for worker_id, process in list(self._processes.items()):
+                    if process.is_alive() or self._stopping:
+                        continue
+                    self._handle_exit(worker_id, process)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.drain()
+        return not self._failed
+
+    def _handle_exit(self, worker_id: int, process: multiprocessing.Process) -> None:
+        """Schedule the restart of an exited worker, then restart it when due."""
+        now = time.monotonic()
+        if worker_id in self._restart_at:
+            if now >= self._restart_at[worker_id]:
+                del self._restart_at[worker_id]
+                self._spawn(worker_id)
+            return
+
+        if now - self._started[worker_id] < _QUICK_FAILURE:
+            self._quick_failures[worker_id] = self._quick_failures.get(worker_id, 0) + 1
+        else:
+            self._quick_failures[worker_id] = 0
+        failures = self._quick_failures[worker_id]
+        if failures >= _MAX_QUICK_FAILURES:
+            print(
+                f"[!] worker {worker_id} failed {failures} times in a row "
+                "at startup, giving up"
+            )
+            self._failed = True
+            self._stopping = True
+            return
+
+        delay = min(_RESTART_DELAY * 2 ** failures, _MAX_RESTART_DELAY)
+        print(
+            f"[!] worker {worker_id} (pid {process.pid}) exited "
+            f"with code {process.exitcode}, restarting in {delay:.1f}s"
+        )
+        self._restart_at[worker_id] = now + delay
+
+    def drain(self) -> None:
+        """Ask every worker to finish its in-flight requests and exit."""
+        print("Draining workers.")
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM
+
+        deadline = time.monotonic() + self.drain_timeout
+        for worker_id, process in self._processes.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"[!] worker {worker_id} did not drain in time, killing it")
+                process.kill()
+                process.join()
@@ -0,0 +1,87 @@
+"""
+Cache warm-up: run the most frequent queries of a query log through the
+search pipeline so that their results and pages land in the shared cache.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import json
+import time
+from typing import *
+from cerche.custom_logging import print
+from cerche.rate_limit import RateLimitExceeded
+
+
+def read_top_queries(path: str, top_k: int, n: int) -> List[Tuple[str, int]]:
+    """Read a query log and return its `top_k` most frequent (q, n) pairs.
+    Lines are either JSON objects as written by the server's query log,
+    or plain queries, in which case `n` is used. Invalid JSON entries,
+    e.g. truncated by a crash, are skipped.
+    """
+    counter = collections.Counter()
+    skipped = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("{"):
+                counter[(line, n)] += 1
+                continue
+            try:
+                entry = json.loads(line)
+                q, entry_n = entry["q"], int(entry.get("n", n))
+            except (ValueError, TypeError, KeyError):
+                skipped += 1
+                continue
+            if not isinstance(q, str) or not q or entry_n < 1:
+                skipped += 1
+                continue
+            counter[(q, entry_n)] += 1
+    if skipped:
+        print(f"[!] skipped {skipped} invalid entries of the query log {path}")
+    return [query for query, _ in counter.most_common(top_k)]
+
+
+def warm_up_cache(
+    server,
+    queries: List[Tuple[str, int]],
+    parallelism: int = 1,
+    interval: float = 0,
+) -> int:
+    """Fetch the results of `queries` into `server.cache`.
+    Queries already cached are skipped. With `interval`, runs at low
+    priority: waits between queries, and only calls the search backend
+    when the rate limiter is idle. Returns the number of queries fetched.
+    """
+    assert server.cache is not None, "warm-up requires a cache"
+    handler = server.RequestHandlerClass.detached(server)
+
+    def fetch(query: Tuple[str, int]) -> bool:
+        q, n = query
+        if server.cache.get("results", handler.result_cache_key(q, n)) is not None:
+            return False
+        priority = (
+            server.rate_limiter.low_priority()
+            if interval
+            else contextlib.nullcontext()
+        )
+        try:
+            with priority:
+                handler.fetch_results(q=q, n=n)
+        except RateLimitExceeded as e:
+            print(f"[!] warm-up skipped `{q}`: {e}")
+            return False
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"[!] warm-up failed for `{q}`: {e}")
+            return False
+        finally:
+            if interval:
+                time.sleep(interval)
+        return True
+
+    print(f"Warming up the cache with {len(queries)} queries.")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        fetched = sum(executor.map(fetch, queries))
+    print(f"Warm-up done, fetched {fetched} queries.")
+    return fetched